@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+archive.py
+
+For packing finished Turbomole directories into compressed archives to save
+quota.  Archives are zip files: every member is compressed on its own and the
+central directory at the end works as an index, so reading the energy file
+back only decompresses the energy file, no matter how large the MOs are.
+Turboclass opens archives read-only through ArchiveDir.
+
+Usage: archive.py pack [--remove] <directories>
+       archive.py unpack <archives>
+===========================
+'''
+
+import sys, os, shutil, zipfile
+import lease
+
+
+# Read-only view of an archived Turbomole directory
+class ArchiveDir(object):
+
+	def __init__(self, archivePath):
+		self.path = os.path.realpath(archivePath)
+		self.zip = zipfile.ZipFile(self.path, 'r')
+		self.names = set(self.zip.namelist())
+
+	def exists(self, name):
+		return name in self.names
+
+	# Returns a file object for a single member, decompressing only it
+	def open(self, name):
+		if name not in self.names:
+			raise IOError("No file %s in archive %s" % (name, self.path))
+		return self.zip.open(name, 'r')
+
+	def close(self):
+		self.zip.close()
+
+
+# Packs turboDir into archivePath (turboDir.zip by default) and returns the
+# path.  Refuses directories jobex is still running in.  The lease on the
+# directory (see lease.py) is held until packing is done, so no job can start
+# in it meanwhile, and lease.LeaseError is raised if a live job holds it.
+# With remove=True the directory is deleted once the archive has been written
+# and checked.
+def pack(turboDir, archivePath=None, remove=False):
+	turboDir = os.path.realpath(turboDir)
+	if archivePath == None:
+		archivePath = turboDir + '.zip'
+	if os.path.exists(os.path.join(turboDir, 'GEO_OPT_RUNNING')):
+		raise IOError("%s is still running" % turboDir)
+
+	held = lease.Lease(turboDir)
+	held.acquire()
+	try:
+		# Write under a temporary name so a half-written archive is never
+		# mistaken for a finished one
+		tempPath = archivePath + '.part'
+		archiveFile = zipfile.ZipFile(tempPath, 'w', zipfile.ZIP_DEFLATED,
+			allowZip64=True)
+		for root, dirs, files in os.walk(turboDir):
+			for name in sorted(files):
+				if root == turboDir and name.startswith(lease.leaseName):
+					continue
+				path = os.path.join(root, name)
+				archiveFile.write(path, os.path.relpath(path, turboDir))
+		archiveFile.close()
+
+		with zipfile.ZipFile(tempPath, 'r') as check:
+			bad = check.testzip()
+		if bad != None:
+			os.remove(tempPath)
+			raise IOError("Archive of %s is corrupt at %s" % (turboDir, bad))
+		os.rename(tempPath, archivePath)
+
+		if remove:
+			held.stopHeartbeat() # Would write into the directory being deleted
+			shutil.rmtree(turboDir)
+	finally:
+		held.release()
+	return archivePath
+
+# Unpacks an archive into turboDir (the archive name without .zip by default)
+def unpack(archivePath, turboDir=None):
+	if turboDir == None:
+		turboDir = os.path.splitext(os.path.realpath(archivePath))[0]
+	with zipfile.ZipFile(archivePath, 'r') as archiveFile:
+		archiveFile.extractall(turboDir)
+	return turboDir
+
+if __name__ == '__main__':
+	def usage():
+		print "Usage: archive.py pack [--remove] <directories>"
+		print "       archive.py unpack <archives>"
+
+	if len(sys.argv) < 3 or sys.argv[1] not in ['pack', 'unpack']:
+		usage()
+		sys.exit(1)
+
+	paths = sys.argv[2:]
+	if sys.argv[1] == 'pack':
+		remove = '--remove' in paths
+		for turboDir in [path for path in paths if path != '--remove']:
+			print "Packed %s" % pack(turboDir, remove=remove)
+	else:
+		for archivePath in paths:
+			print "Unpacked %s" % unpack(archivePath)
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+lease.py
+
+For keeping two jobs from running in the same Turbomole directory at once.
+A job holds a lease, the file .turbolease with its host, pid and a heartbeat
+time that a background thread keeps refreshing.  Reading and writing the lease
+happens under an fcntl lock on .turbolease.lock, which also works over NFS.
+A lease whose heartbeat is older than ttl, or whose process is gone on this
+host, was left by a killed job and is taken over.
+
+Usage: lease.py <turbomole directories>    (shows who holds each one)
+===========================
+'''
+
+import sys, os, errno, time, socket, fcntl, threading, atexit
+
+leaseName = '.turbolease'
+
+# Seconds without a heartbeat after which a lease counts as stale
+defaultTTL = 600
+
+# Leases held by this process, released at exit
+heldLeases = set()
+
+
+# Raised when another live job holds the lease
+class LeaseError(Exception):
+	pass
+
+
+# Returns (host, pid, heartbeat) from a lease file, or None if there is none
+def readLease(path):
+	try:
+		with open(path, 'r') as leaseFile:
+			host, pid, heartbeat = leaseFile.read().split()
+		return host, int(pid), float(heartbeat)
+	except (IOError, ValueError):
+		return None
+
+# True if the process in a lease is certainly dead.  Only decidable for
+# processes on this host, others go by their heartbeat.
+def deadOwner(host, pid):
+	if host != socket.gethostname():
+		return False
+	try:
+		os.kill(pid, 0)
+	except OSError as e:
+		return e.errno == errno.ESRCH
+	return False
+
+
+class Lease(object):
+
+	def __init__(self, turboDir, ttl=defaultTTL, heartbeat=60):
+		self.turboDir = os.path.realpath(turboDir)
+		self.path = os.path.join(self.turboDir, leaseName)
+		self.ttl = ttl
+		self.heartbeat = heartbeat
+		self.host = socket.gethostname()
+		self.pid = os.getpid()
+		self.held = False
+		self.stop = threading.Event()
+		self.thread = None
+
+	# Runs function with the lease file locked against other jobs
+	def locked(self, function):
+		with open(self.path + '.lock', 'a') as lockFile:
+			fcntl.lockf(lockFile, fcntl.LOCK_EX)
+			try:
+				return function()
+			finally:
+				fcntl.lockf(lockFile, fcntl.LOCK_UN)
+
+	def write(self):
+		tempPath = self.path + '.%s.%d' % (self.host, self.pid)
+		with open(tempPath, 'w') as leaseFile:
+			leaseFile.write("%s %d %f\n" % (self.host, self.pid, time.time()))
+		os.rename(tempPath, self.path)
+
+	# Takes the lease, raising LeaseError if another live job holds it.
+	# Returns a message saying whether a stale lease was reclaimed.
+	def acquire(self):
+		def take():
+			current = readLease(self.path)
+			message = "Lease taken on %s" % self.turboDir
+			if current != None and current[:2] != (self.host, self.pid):
+				host, pid, beat = current
+				if time.time() - beat < self.ttl and not deadOwner(host, pid):
+					raise LeaseError("%s is in use by pid %d on %s" %
+						(self.turboDir, pid, host))
+				message = "Reclaimed stale lease on %s from pid %d on %s" % \
+					(self.turboDir, pid, host)
+			self.write()
+			return message
+
+		message = self.locked(take)
+		self.held = True
+		heldLeases.add(self)
+		self.stop.clear()
+		self.thread = threading.Thread(target=self.beat)
+		self.thread.daemon = True
+		self.thread.start()
+		return message
+
+	# Heartbeat thread.  Stops refreshing if someone else took the lease over.
+	def beat(self):
+		def refresh():
+			current = readLease(self.path)
+			if current == None or current[:2] != (self.host, self.pid):
+				return False
+			self.write()
+			return True
+
+		while not self.stop.wait(self.heartbeat):
+			if not self.locked(refresh):
+				self.held = False
+				return
+
+	# Stops refreshing the lease.  It stays held until it is released or its
+	# heartbeat is older than ttl.
+	def stopHeartbeat(self):
+		self.stop.set()
+		if self.thread != None and self.thread != threading.current_thread():
+			self.thread.join()
+			self.thread = None
+
+	# Gives up the lease.  Nothing is left to remove if the directory itself
+	# has been deleted meanwhile, eg by archive.pack.
+	def release(self):
+		def remove():
+			current = readLease(self.path)
+			if current != None and current[:2] == (self.host, self.pid):
+				os.remove(self.path)
+
+		self.stopHeartbeat()
+		if self.held and os.path.isdir(self.turboDir):
+			self.locked(remove)
+			self.held = False
+		heldLeases.discard(self)
+
+def releaseAll():
+	for lease in list(heldLeases):
+		lease.release()
+
+atexit.register(releaseAll)
+
+if __name__ == '__main__':
+	dirs = sys.argv[1:]
+	if len(dirs) == 0:
+		dirs = [os.getcwd()]
+	for turboDir in dirs:
+		current = readLease(os.path.join(turboDir, leaseName))
+		if current == None:
+			print "%s: free" % turboDir
+		else:
+			print "%s: pid %d on %s, heartbeat %d s ago" % (turboDir,
+				current[1], current[0], time.time() - current[2])
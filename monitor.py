@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+monitor.py
+
+For watching running jobex optimizations as they go.  Tails the energy,
+gradient and job output files of a Turbomole directory, reading only the bytes
+that were added since the last look, and publishes energy, gradient norm and
+step time for every new optimization cycle.  Uses inotify to wake up when
+something in the directory changes, and falls back to polling where inotify
+is not available.
+
+Usage: monitor.py <turbomole directories>
+===========================
+'''
+
+import sys, os, re, time, select
+
+# inotify through libc.  If any of this fails, JobMonitor just polls.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+try:
+	import ctypes, ctypes.util
+	_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+		use_errno=True)
+	_libc.inotify_init
+	_libc.inotify_add_watch
+except Exception:
+	_libc = None
+
+# Returns an inotify file descriptor watching directory, or None if inotify
+# can't be used here
+def inotifyWatch(directory):
+	if _libc is None:
+		return None
+	fd = _libc.inotify_init()
+	if fd < 0:
+		return None
+	mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+	if _libc.inotify_add_watch(fd, directory, mask) < 0:
+		os.close(fd)
+		return None
+	return fd
+
+# Header line of each gradient block, eg
+#   cycle =      2    SCF energy =      -75.9608669943   |dE/dxyz| =  0.015536
+gradHeader = re.compile(r'cycle\s*=\s*(\d+)\s+\S+\s+energy\s*=\s*(\S+)'
+	r'\s+\|dE/dxyz\|\s*=\s*(\S+)')
+
+
+# Follows a single file, handing back complete lines that were added since the
+# last call.  Turbomole rewrites energy and gradient in place to keep $end at
+# the bottom, so the $end line is never consumed and the next read starts where
+# it used to be.  If the file is replaced or shrinks, reading starts over.
+class FileTail(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.inode = None
+		self.offset = 0
+
+	# Returns a list of the new complete lines
+	def readLines(self):
+		try:
+			stat = os.stat(self.path)
+		except OSError:
+			return []
+
+		if stat.st_ino != self.inode or stat.st_size < self.offset:
+			self.inode = stat.st_ino
+			self.offset = 0
+		if stat.st_size == self.offset:
+			return []
+
+		with open(self.path, 'r') as tailFile:
+			tailFile.seek(self.offset)
+			data = tailFile.read()
+
+		lines = []
+		for line in data.splitlines(True):
+			# Wait for the rest of a half-written line, and leave $end alone
+			if not line.endswith('\n') or line.startswith('$end'):
+				break
+			lines.append(line)
+			self.offset += len(line)
+		return lines
+
+
+# Watches a Turbomole directory while jobex runs in it.  Every new cycle is
+# published as a dictionary with 'cycle', 'energy', 'gradnorm' and 'steptime'
+# (seconds since the previous cycle was seen) to log, to callback, and to
+# anyone iterating over follow().  outPath is the job output to tail, relative
+# to the directory; jobex itself keeps the current step in job.last.
+class JobMonitor(object):
+
+	def __init__(self, turboDir, outPath='job.last', callback=None, log=None,
+		interval=2.0, echo=False):
+		self.turboDir = os.path.realpath(turboDir)
+		self.callback = callback
+		self.log = log
+		self.interval = interval
+		self.echo = echo
+
+		self.energyTail = FileTail(os.path.join(self.turboDir, 'energy'))
+		self.gradTail = FileTail(os.path.join(self.turboDir, 'gradient'))
+		if outPath != None:
+			self.outTail = FileTail(os.path.join(self.turboDir, outPath))
+		else:
+			self.outTail = None
+
+		self.energies = {}
+		self.published = set()
+		self.cycles = []
+		self.stopped = False # True once the output reports an abnormal end
+		self.watchFd = inotifyWatch(self.turboDir)
+
+		# Catch up on what is already there without publishing it, so rereads
+		# after Turbomole rewrites a file don't report old cycles again
+		self.poll(publish=False)
+		self.lastTime = time.time()
+
+	def __iter__(self):
+		return self.follow()
+
+	# Reads whatever is new and returns a list of newly finished cycles
+	def poll(self, publish=True):
+		for line in self.energyTail.readLines():
+			fields = line.split()
+			if len(fields) >= 2 and fields[0].isdigit():
+				self.energies[int(fields[0])] = float(fields[1])
+
+		records = []
+		for line in self.gradTail.readLines():
+			match = gradHeader.search(line)
+			if match == None:
+				continue
+			cycle = int(match.group(1))
+			if cycle in self.published:
+				continue
+			self.published.add(cycle)
+			if not publish:
+				continue
+			now = time.time()
+			energy = self.energies.get(cycle,
+				float(match.group(2).replace('D', 'E')))
+			records.append({'cycle': cycle, 'energy': energy,
+				'gradnorm': float(match.group(3).replace('D', 'E')),
+				'steptime': now - self.lastTime})
+			self.lastTime = now
+
+		if self.outTail != None:
+			for line in self.outTail.readLines():
+				if not publish:
+					continue
+				if 'program stopped' in line or 'ended abnormally' in line:
+					self.stopped = True
+				if self.echo:
+					sys.stdout.write(line)
+
+		for record in records:
+			self.cycles.append(record)
+			if self.log != None:
+				self.log("Cycle %4d  energy = %.10f  |dE/dxyz| = %.6f  " \
+					"step time = %.1f s" % (record['cycle'], record['energy'],
+					record['gradnorm'], record['steptime']))
+			if self.callback != None:
+				self.callback(record)
+		return records
+
+	# Blocks until something in the directory changes or interval runs out
+	def wait(self, interval=None):
+		if interval == None:
+			interval = self.interval
+		if self.watchFd == None:
+			time.sleep(interval)
+			return
+		ready = select.select([self.watchFd], [], [], interval)[0]
+		if ready:
+			os.read(self.watchFd, 65536) # Drain events, poll() does the rest
+
+	# True while the job is still going.  With a Popen object this follows the
+	# process, otherwise the GEO_OPT_RUNNING file jobex keeps around.
+	def running(self, proc=None):
+		if proc != None:
+			return proc.poll() == None
+		return os.path.exists(os.path.join(self.turboDir, 'GEO_OPT_RUNNING'))
+
+	# Generator yielding each new cycle until the job finishes, or until its
+	# output reports an abnormal end (stopped is then True)
+	def follow(self, proc=None):
+		while self.running(proc) and not self.stopped:
+			for record in self.poll():
+				yield record
+			self.wait()
+		for record in self.poll():
+			yield record
+
+	def close(self):
+		if self.watchFd != None:
+			os.close(self.watchFd)
+			self.watchFd = None
+
+
+if __name__ == '__main__':
+	dirs = sys.argv[1:]
+	if len(dirs) == 0:
+		dirs = [os.getcwd()]
+
+	# One polling loop over every directory, printing cycles as they show up
+	def printer(directory):
+		def log(message):
+			print "%s: %s" % (directory, message)
+		return log
+
+	monitors = [JobMonitor(d, log=printer(d)) for d in dirs]
+	while len(monitors) > 0:
+		for mon in monitors[:]:
+			mon.poll()
+			if mon.stopped:
+				print "%s: job output reports an abnormal end" % mon.turboDir
+			if mon.stopped or not mon.running():
+				print "%s: job is no longer running" % mon.turboDir
+				mon.close()
+				monitors.remove(mon)
+		if len(monitors) > 0:
+			time.sleep(2.0)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+profiling.py
+
+For seeing where the driver itself spends time between Turbomole runs.  When
+switched on, every Turboclass method call becomes a span in a timeline, with
+the Turbomole programs it starts on their own track next to it, and the
+timeline is written as Chrome trace JSON that chrome://tracing and Perfetto
+open.  cProfile and tracemalloc can be switched on alongside it; cProfile
+statistics go next to the trace as <trace>.prof.  Everything is off, and
+costs one check per call, until tracer.start() is called.
+===========================
+'''
+
+import os, time, json, threading, functools, atexit
+
+try:
+	import cProfile
+except ImportError:
+	cProfile = None
+
+try:
+	import tracemalloc # Python 3.4 and up
+except ImportError:
+	tracemalloc = None
+
+# Timeline tracks
+pythonTrack = 1
+turbomoleTrack = 2
+
+
+class Tracer(object):
+
+	def __init__(self):
+		self.enabled = False
+		self.path = None
+		self.events = []
+		self.profiler = None
+		self.memory = False
+		self.lock = threading.Lock()
+
+	# Switches tracing on.  The trace is written to path at exit, or whenever
+	# export() is called.
+	def start(self, path=None, cprofile=False, memory=False):
+		self.path = path
+		self.enabled = True
+		if cprofile and cProfile != None:
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		if memory and tracemalloc == None:
+			print "tracemalloc is not available in this Python (3.4 and up " \
+				"only), memory will not be recorded"
+		elif memory:
+			tracemalloc.start()
+			self.memory = True
+
+	def stop(self):
+		self.enabled = False
+		if self.profiler != None:
+			self.profiler.disable()
+		if self.memory:
+			tracemalloc.stop()
+			self.memory = False
+
+	# Adds a complete span.  start is a time.time() value, duration seconds.
+	def record(self, name, category, start, duration, track=pythonTrack,
+		args=None):
+		event = {'name': name, 'cat': category, 'ph': 'X',
+			'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+			'pid': os.getpid(), 'tid': track}
+		if args != None:
+			event['args'] = args
+		with self.lock:
+			self.events.append(event)
+
+	# Wraps function so each call is recorded as a span named name
+	def wrap(self, function, name):
+		tracer = self
+
+		@functools.wraps(function)
+		def traced(*args, **kwargs):
+			if not tracer.enabled:
+				return function(*args, **kwargs)
+			if tracer.memory:
+				before = tracemalloc.get_traced_memory()[0]
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				spanArgs = None
+				if tracer.memory:
+					spanArgs = {'allocated bytes':
+						tracemalloc.get_traced_memory()[0] - before}
+				tracer.record(name, 'python', start, time.time() - start,
+					args=spanArgs)
+		return traced
+
+	# Writes the Chrome trace to path (the one given to start by default), and
+	# the cProfile statistics to path.prof
+	def export(self, path=None):
+		if path == None:
+			path = self.path
+		if path == None:
+			return
+
+		names = [(pythonTrack, 'Python'), (turbomoleTrack, 'Turbomole')]
+		metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+			'tid': track, 'args': {'name': trackName}}
+			for track, trackName in names]
+		with self.lock:
+			events = metadata + list(self.events)
+		with open(path, 'w') as traceFile:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+
+		if self.profiler != None:
+			self.profiler.dump_stats(path + '.prof')
+
+
+# The tracer used by Turboclass
+tracer = Tracer()
+
+def exportAtExit():
+	if tracer.enabled:
+		tracer.export()
+
+atexit.register(exportAtExit)
+
+# Wraps every method defined on cls so its calls show up in the timeline
+def instrument(cls):
+	for attribute, value in list(vars(cls).items()):
+		if callable(value):
+			setattr(cls, attribute,
+				tracer.wrap(value, '%s.%s' % (cls.__name__, attribute)))
+	return cls
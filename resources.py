@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+resources.py
+
+For picking cores and memory for a Turbomole job from the size of the system
+instead of always asking for the same node.  Counts atoms from coord and basis
+functions from basis/auxbasis, estimates what ridft and rdgrad need, chooses
+the number of cores per job that keeps the most jobs running on a node without
+swapping, and writes $ricore and $maxcor into control to match.
+
+Usage: resources.py <turbomole directory> [cores per node] [memory per core]
+===========================
+'''
+
+import sys, os, re
+
+# Number of spherical functions in a shell of each angular momentum
+shellSize = {'s': 1, 'p': 3, 'd': 5, 'f': 7, 'g': 9, 'h': 11, 'i': 13}
+
+# Memory every Turbomole process needs regardless of system size, in MB
+overheadMB = 300
+
+# Rough fraction of a ridft/rdgrad step that doesn't speed up with more cores.
+# Only used to extrapolate step times measured at another core count.
+serialFraction = 0.1
+
+
+# Returns memory per core in GB from an SGE h_data value such as 4, "4G",
+# "4.5g" or "512M"
+def parseMemory(value):
+	text = str(value).strip().upper()
+	if text.endswith('B'):
+		text = text[:-1]
+	scale = 1.0
+	if text.endswith('G'):
+		text = text[:-1]
+	elif text.endswith('M'):
+		text = text[:-1]
+		scale = 1.0 / 1024
+	try:
+		return float(text) * scale
+	except ValueError:
+		raise ValueError("Memory per core '%s' is not a number of GB or a " \
+			"value like 4G or 512M" % value)
+
+# Returns the element of every atom in coord, in order
+def readElements(coord):
+	elements = []
+	with open(coord, 'r') as coordFile:
+		inCoord = False
+		for line in coordFile:
+			if line.startswith('$'):
+				inCoord = line.startswith('$coord')
+				continue
+			fields = line.split()
+			if inCoord and len(fields) >= 4:
+				elements.append(fields[3].lower())
+	return elements
+
+# Returns the number of atoms in coord
+def countAtoms(coord):
+	return len(readElements(coord))
+
+# Returns a dictionary of element -> number of basis functions from a
+# Turbomole basis or auxbasis file
+def readBasisSizes(basis):
+	sizes = {}
+	current = None
+	afterStar = False
+	with open(basis, 'r') as basisFile:
+		for line in basisFile:
+			fields = line.split()
+			if len(fields) == 0 or line.startswith('#') or line.startswith('$'):
+				continue
+			if fields[0] == '*':
+				afterStar = True
+				continue
+			isShell = len(fields) == 2 and fields[0].isdigit() and \
+				fields[1].lower() in shellSize
+			if isShell and current != None:
+				sizes[current] += shellSize[fields[1].lower()]
+			elif afterStar and not isShell:
+				# "h def2-SVP" header naming the element of the next block
+				current = fields[0].lower()
+				sizes[current] = 0
+			afterStar = False
+	return sizes
+
+# Returns the total number of basis functions for elements in basis, or None
+# if the basis file is missing or doesn't cover every element
+def countBasis(basis, elements):
+	if not os.path.isfile(basis):
+		return None
+	sizes = readBasisSizes(basis)
+	try:
+		return sum([sizes[element] for element in elements])
+	except KeyError:
+		return None
+
+# Returns nbf(AO) from $rundimensions in control, or None if it isn't there
+def controlBasis(control):
+	with open(control, 'r') as controlFile:
+		for line in controlFile:
+			if 'nbf(AO)=' in line:
+				return int(line.split('=')[-1])
+	return None
+
+# Returns a list of (cores, seconds) for every step time recorded in
+# a turbohistory.log, using the resource plan logged before each step
+def readStepTimes(logPath):
+	steps = []
+	if not os.path.isfile(logPath):
+		return steps
+	cores = None
+	with open(logPath, 'r') as logFile:
+		for line in logFile:
+			planMatch = re.search(r'Resource plan: (\d+) cores', line)
+			if planMatch:
+				cores = int(planMatch.group(1))
+				continue
+			stepMatch = re.search(r'step time = ([\d.]+) s', line)
+			if stepMatch and cores != None:
+				steps.append((cores, float(stepMatch.group(1))))
+	return steps
+
+# Amdahl's law estimate of the time for one step on cores, relative to serial
+def relativeTime(cores):
+	return serialFraction + (1 - serialFraction) / float(cores)
+
+# Returns a dictionary describing the resources a job in turboDir should use.
+# nodeCores and memPerCore (GB) describe the node type.  If walltime (hours)
+# is given and earlier step times are in the log, more cores are used when
+# needed to finish steps optimization cycles in time.
+def plan(turboDir, nodeCores=12, memPerCore=4, walltime=None, steps=20):
+	turboDir = os.path.realpath(turboDir)
+	elements = readElements(os.path.join(turboDir, 'coord'))
+	atoms = len(elements)
+
+	nbf = countBasis(os.path.join(turboDir, 'basis'), elements)
+	if nbf == None:
+		nbf = controlBasis(os.path.join(turboDir, 'control'))
+	if nbf == None:
+		nbf = 15 * atoms # About def2-SVP for organic atoms
+	naux = countBasis(os.path.join(turboDir, 'auxbasis'), elements)
+	if naux == None:
+		naux = 3 * nbf
+
+	# A dozen nbf x nbf matrices for ridft/rdgrad (Fock, density, MOs, DIIS),
+	# and the 3-index RI integrals if they were all kept in memory
+	scfMB = 8.0 * 12 * nbf * nbf / 2**20 + overheadMB
+	riMB = 8.0 * naux * nbf * (nbf + 1) / 2 / 2**20
+
+	# Fewest cores whose memory holds the job with some headroom.  Fewer
+	# cores per job means more jobs per node, and better total throughput.
+	candidates = [n for n in range(1, nodeCores + 1) if nodeCores % n == 0]
+	cores = candidates[-1]
+	for n in candidates:
+		if n * memPerCore * 1024 >= 1.25 * scfMB:
+			cores = n
+			break
+
+	# Add cores if the measured step times wouldn't fit in the walltime
+	history = readStepTimes(os.path.join(turboDir, 'turbohistory.log'))
+	if walltime != None and len(history) > 0:
+		lastCores = history[-1][0]
+		times = sorted([t for n, t in history if n == lastCores])
+		median = times[len(times) // 2]
+		for n in candidates:
+			if n < cores:
+				continue
+			cores = n
+			predicted = median * relativeTime(n) / relativeTime(lastCores)
+			if predicted * steps <= 0.9 * walltime * 3600:
+				break
+
+	# Split what is left after the SCF between $ricore and $maxcor.  With MPI
+	# every process gets its own $ricore, with SMP they share one.
+	jobMB = cores * memPerCore * 1024
+	if os.environ.get('PARA_ARCH') == 'MPI':
+		jobMB = jobMB / cores
+	freeMB = max(0, jobMB - scfMB)
+	ricore = int(max(100, min(riMB + 10, 0.5 * freeMB)))
+	maxcor = int(max(200, 0.9 * freeMB - ricore))
+
+	return {'atoms': atoms, 'nbf': nbf, 'naux': naux, 'cores': cores,
+		'jobsPerNode': nodeCores // cores, 'memPerCore': memPerCore,
+		'ricore': ricore, 'maxcor': maxcor}
+
+# Replaces a single line data group in control, eg "$ricore 200", or adds it
+# before $end if it isn't there yet
+def setControlGroup(control, group, value):
+	with open(control, 'r') as controlFile:
+		lines = controlFile.readlines()
+
+	newLine = "%s    %s\n" % (group, value)
+	for index, line in enumerate(lines):
+		if len(line.split()) > 0 and line.split()[0] == group:
+			lines[index] = newLine
+			break
+	else:
+		for index, line in enumerate(lines):
+			if line.startswith('$end'):
+				lines.insert(index, newLine)
+				break
+		else:
+			lines.append(newLine)
+
+	with open(control, 'w') as controlFile:
+		for line in lines:
+			controlFile.write(line)
+
+# Writes $ricore/$maxcor into control
+def apply(turboDir, resourcePlan):
+	control = os.path.join(os.path.realpath(turboDir), 'control')
+	setControlGroup(control, '$ricore', resourcePlan['ricore'])
+	setControlGroup(control, '$maxcor', resourcePlan['maxcor'])
+
+# Returns a copy of os.environ with PARNODES/OMP_NUM_THREADS set for a plan,
+# to hand to the Turbomole programs of that directory only.  PARA_ARCH is left
+# to the submission script, since it has to be set before Turbomole's PATH is.
+def environment(resourcePlan):
+	env = dict(os.environ)
+	env['PARNODES'] = str(resourcePlan['cores'])
+	env['OMP_NUM_THREADS'] = str(resourcePlan['cores'])
+	return env
+
+# One line description of a plan, also read back by readStepTimes
+def describe(resourcePlan):
+	return "Resource plan: %d cores (%d jobs per node) for %d atoms, " \
+		"%d basis functions, %d auxiliary.  $ricore %d, $maxcor %d" % \
+		(resourcePlan['cores'], resourcePlan['jobsPerNode'],
+		resourcePlan['atoms'], resourcePlan['nbf'], resourcePlan['naux'],
+		resourcePlan['ricore'], resourcePlan['maxcor'])
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print "Usage: resources.py <turbomole directory> [cores per node] " \
+			"[memory per core, eg 4G]"
+		sys.exit(1)
+
+	nodeCores = 12
+	memPerCore = 4
+	if len(sys.argv) > 2:
+		nodeCores = int(sys.argv[2])
+	if len(sys.argv) > 3:
+		memPerCore = parseMemory(sys.argv[3])
+
+	print describe(plan(sys.argv[1], nodeCores, memPerCore))
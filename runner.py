@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+runner.py
+
+For running Turbomole programs.  Every run is started without a shell in its
+own process group with its output going to a file, can be given a timeout,
+and is killed along with all of its children when the timeout runs out, when
+the driver gets SIGTERM/SIGINT/SIGUSR2 from the queue, or when the driver
+exits.  SIGUSR1, which SGE -notify sends before suspending a job, is ignored
+so the job can be resumed.  Finished runs are described by a RunResult.
+===========================
+'''
+
+import os, sys, signal, shlex, subprocess, time, atexit
+
+# Seconds to wait after SIGTERM before sending SIGKILL to a process group
+killGrace = 10
+
+# Seconds between checks on a run that has a timeout
+pollInterval = 0.5
+
+# Runs that have been started but not finished, so they can be cleaned up
+activeRuns = set()
+
+
+# Everything known about a finished run.  startTime and endTime are the
+# time.time() values at which the program was started and seen to finish.
+class RunResult(object):
+
+	def __init__(self, command, returncode, startTime, endTime, outPath,
+		timedOut):
+		self.command = command
+		self.returncode = returncode
+		self.startTime = startTime
+		self.endTime = endTime
+		self.duration = endTime - startTime
+		self.outPath = outPath
+		self.timedOut = timedOut
+		with open(outPath, 'r') as outFile:
+			self.output = outFile.read()
+
+	# True if the run timed out, exited nonzero or was killed by a signal
+	# (negative returncode, eg -9 from the OOM killer), or its output
+	# contains marker
+	def failed(self, marker):
+		return self.timedOut or self.returncode != 0 or marker in self.output
+
+
+# A single program run.  poll() matches Popen.poll(), so a Run can be handed
+# to JobMonitor.follow() in place of a Popen object.
+class Run(object):
+
+	def __init__(self, command, cwd, outPath, timeout=None, env=None):
+		self.command = command
+		self.cwd = cwd
+		self.outPath = outPath
+		self.timeout = timeout
+		self.env = env
+		self.proc = None
+		self.startTime = None
+		self.endTime = None
+		self.timedOut = False
+
+	def start(self):
+		installHandlers()
+		with open(self.outPath, 'w') as outFile:
+			self.proc = subprocess.Popen(shlex.split(self.command), cwd=self.cwd,
+				stdout=outFile, stderr=subprocess.STDOUT, preexec_fn=os.setsid,
+				env=self.env)
+		self.startTime = time.time()
+		activeRuns.add(self)
+		return self
+
+	# Returns the exit code, or None while running.  Kills the run if it has
+	# gone past its timeout.
+	def poll(self):
+		returncode = self.proc.poll()
+		if returncode == None and self.timeout != None and \
+			time.time() - self.startTime > self.timeout:
+			self.timedOut = True
+			self.kill()
+			returncode = self.proc.poll()
+		if returncode != None:
+			self.finish()
+		return returncode
+
+	def wait(self):
+		if self.timeout == None:
+			self.proc.wait()
+		while self.poll() == None:
+			time.sleep(pollInterval)
+		return self.result()
+
+	# Sends SIGTERM to the whole process group, then SIGKILL to whatever is
+	# left of it once the program is down or the grace period is over
+	def kill(self):
+		try:
+			os.killpg(self.proc.pid, signal.SIGTERM)
+			deadline = time.time() + killGrace
+			while self.proc.poll() == None and time.time() < deadline:
+				time.sleep(0.1)
+			os.killpg(self.proc.pid, signal.SIGKILL)
+		except OSError:
+			pass # Group is already gone
+		self.proc.wait()
+		self.finish()
+
+	# Records the end time and kills anything the program left running in its
+	# process group, eg background children of NumForce
+	def finish(self):
+		if self.endTime == None:
+			self.endTime = time.time()
+		try:
+			os.killpg(self.proc.pid, signal.SIGKILL)
+		except OSError:
+			pass # Nothing left in the group
+		activeRuns.discard(self)
+
+	def result(self):
+		return RunResult(self.command, self.proc.returncode, self.startTime,
+			self.endTime, self.outPath, self.timedOut)
+
+
+# Runs command in cwd with its output in outPath and returns a RunResult.
+# env replaces the environment of the program, as for Popen.
+def run(command, cwd, outPath, timeout=None, env=None):
+	return Run(command, cwd, outPath, timeout, env).start().wait()
+
+# Kills everything still running.  Registered with atexit.
+def killAll():
+	for activeRun in list(activeRuns):
+		activeRun.kill()
+
+def handleSignal(signum, frame):
+	killAll()
+	sys.exit(128 + signum)
+
+# SIGUSR1 only warns of a suspend, which stops the programs along with the
+# driver and resumes them later.  Without a handler it would kill the driver.
+def ignoreSignal(signum, frame):
+	pass
+
+# Installs handlers that kill running programs when the driver is stopped.
+# Only possible from the main thread, so other threads just go without.
+handlersInstalled = False
+def installHandlers():
+	global handlersInstalled
+	if handlersInstalled:
+		return
+	try:
+		for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGUSR2]:
+			signal.signal(sig, handleSignal)
+		signal.signal(signal.SIGUSR1, ignoreSignal)
+	except ValueError:
+		return
+	atexit.register(killAll)
+	handlersInstalled = True
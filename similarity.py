@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+similarity.py
+
+For finding the most similar converged structure from earlier runs, so a new
+job can start from its orbitals, Hessian guess and frozen internals instead
+of from scratch.  Only the QM region is compared, ie the atoms not frozen in
+coord (all atoms if none are frozen).  Entries with the same QM composition
+are ranked by a cheap fingerprint, the sorted distances of the atoms from
+their centroid, and the best few by the RMS difference of their interatomic
+distance matrices, which needs no alignment.
+
+Usage: similarity.py add <index> <converged directories>
+       similarity.py query <index> <coord>
+===========================
+'''
+
+import sys, os, json, fcntl
+
+# Number of fingerprint matches compared by full distance matrix
+candidates = 10
+
+
+# Returns the (element, x, y, z) of the QM region atoms in a coord file
+def readQMRegion(coord):
+	atoms = []
+	frozen = []
+	with open(coord, 'r') as coordFile:
+		inCoord = False
+		for line in coordFile:
+			if line.startswith('$'):
+				inCoord = line.startswith('$coord')
+				continue
+			fields = line.split()
+			if not inCoord or len(fields) < 4:
+				continue
+			atom = (fields[3].lower(), float(fields[0]), float(fields[1]),
+				float(fields[2]))
+			atoms.append(atom)
+			frozen.append(len(fields) > 4 and fields[4] == 'f')
+
+	if any(frozen):
+		atoms = [atom for atom, isFrozen in zip(atoms, frozen) if not isFrozen]
+	return atoms
+
+# Composition of a list of atoms, eg "c2h6o1".  Only entries with the same
+# composition are compared.
+def composition(atoms):
+	counts = {}
+	for atom in atoms:
+		counts[atom[0]] = counts.get(atom[0], 0) + 1
+	return ''.join(['%s%d' % (element, counts[element])
+		for element in sorted(counts)])
+
+def distance(a, b):
+	return ((a[1]-b[1])**2 + (a[2]-b[2])**2 + (a[3]-b[3])**2) ** 0.5
+
+# Sorted distances of the atoms from their centroid.  Doesn't change with
+# rotation, translation or atom order.
+def fingerprint(atoms):
+	n = float(len(atoms))
+	centroid = (None, sum([a[1] for a in atoms]) / n,
+		sum([a[2] for a in atoms]) / n, sum([a[3] for a in atoms]) / n)
+	return sorted([distance(atom, centroid) for atom in atoms])
+
+def rmsDifference(first, second):
+	return (sum([(a - b)**2 for a, b in zip(first, second)]) /
+		float(len(first))) ** 0.5
+
+# RMS difference of the interatomic distances of two structures with the
+# same atom order, in bohr
+def distanceRMSD(first, second):
+	total = 0.0
+	pairs = 0
+	for i in range(len(first)):
+		for j in range(i):
+			total += (distance(first[i], first[j]) -
+				distance(second[i], second[j]))**2
+			pairs += 1
+	if pairs == 0:
+		return 0.0
+	return (total / pairs) ** 0.5
+
+
+# Index of converged geometries kept in a json file shared by a campaign
+class GeometryIndex(object):
+
+	def __init__(self, path):
+		self.path = os.path.realpath(path)
+		self.entries = {}
+		self.missing = []
+		if os.path.isfile(self.path):
+			with open(self.path, 'r') as indexFile:
+				self.entries = json.load(indexFile)
+
+	def __len__(self):
+		return len(self.entries)
+
+	# Adds (or replaces) the geometry in turboDir/coord.  Returns False and
+	# adds nothing if coord has no QM region, ie no atoms or only frozen ones.
+	def add(self, turboDir):
+		turboDir = os.path.realpath(turboDir)
+		atoms = readQMRegion(os.path.join(turboDir, 'coord'))
+		if len(atoms) == 0:
+			return False
+		self.entries[turboDir] = {'composition': composition(atoms),
+			'fingerprint': fingerprint(atoms), 'atoms': atoms}
+		return True
+
+	# Writes the index, merging in entries other jobs saved in the meantime
+	def save(self):
+		with open(self.path + '.lock', 'w') as lockFile:
+			fcntl.flock(lockFile, fcntl.LOCK_EX)
+			if os.path.isfile(self.path):
+				with open(self.path, 'r') as indexFile:
+					saved = json.load(indexFile)
+				saved.update(self.entries)
+				self.entries = saved
+
+			tempPath = self.path + '.part'
+			with open(tempPath, 'w') as indexFile:
+				json.dump(self.entries, indexFile)
+			os.rename(tempPath, self.path)
+
+	# Returns (directory, distance RMSD) of the closest entry to the QM region
+	# of coord, or None if nothing has the same composition or coord has no QM
+	# region.  exclude is a directory to skip, eg the one being queried for.
+	# Entries whose directory no longer exists (eg archived and removed) are
+	# skipped and listed in self.missing.
+	def nearest(self, coord, exclude=None):
+		atoms = readQMRegion(coord)
+		self.missing = []
+		if len(atoms) == 0:
+			return None
+		key = composition(atoms)
+		prints = fingerprint(atoms)
+		if exclude != None:
+			exclude = os.path.realpath(exclude)
+
+		matches = []
+		for turboDir, entry in self.entries.items():
+			if entry['composition'] != key or turboDir == exclude:
+				continue
+			if not os.path.isdir(turboDir):
+				self.missing.append(turboDir)
+				continue
+			matches.append((rmsDifference(prints, entry['fingerprint']), turboDir))
+		matches.sort()
+
+		best = None
+		for score, turboDir in matches[:candidates]:
+			rmsd = distanceRMSD(atoms, self.entries[turboDir]['atoms'])
+			if best == None or rmsd < best[1]:
+				best = (turboDir, rmsd)
+		return best
+
+if __name__ == '__main__':
+	def usage():
+		print "Usage: similarity.py add <index> <converged directories>"
+		print "       similarity.py query <index> <coord>"
+
+	if len(sys.argv) < 4 or sys.argv[1] not in ['add', 'query']:
+		usage()
+		sys.exit(1)
+
+	index = GeometryIndex(sys.argv[2])
+	if sys.argv[1] == 'add':
+		for turboDir in sys.argv[3:]:
+			if not index.add(turboDir):
+				print "Skipped %s, its coord has no atoms outside the frozen " \
+					"region" % turboDir
+		index.save()
+		print "%d structures in %s" % (len(index), index.path)
+	else:
+		best = index.nearest(sys.argv[3])
+		if best == None:
+			print "No structure with the same QM region found"
+		else:
+			print "%s (%.4f bohr)" % best
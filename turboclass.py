@@ -18,8 +18,10 @@ March 2015, UCLA
 ==============================================================================
 '''
 
-import os, sys, optparse, subprocess
-import freeze, unfreeze
+import os, sys, optparse, shutil, re, functools
+import freeze, unfreeze, resources, runner, archive, similarity, lease
+import profiling
+from monitor import JobMonitor
 
 # For easy submission, FINISH LATER.  LONG TERM.
 def createSubmission(options):
@@ -41,19 +43,67 @@ parser.add_option('-a',	action="store", type=str, default="autointernal", dest="
 						help="Jobname as you want it to appear in the queue")
 parser.add_option('--sub',	action="store_true",	default=False,	dest="submit",
 						help="Inclusion of this command with submit the script")
+parser.add_option('--auto',	action="store_true",	default=False,	dest="auto",
+						help="Pick cores and memory from the size of the system")
+parser.add_option('--profile',	action="store", type=str, default=None, dest="profile",
+						help="Write a Chrome trace timeline of the driver to this file")
+parser.add_option('--cprofile',	action="store_true",	default=False,	dest="cprofile",
+						help="Also write cProfile statistics next to the trace")
+parser.add_option('--tracemalloc',	action="store_true",	default=False,	dest="tracemalloc",
+						help="Also record memory allocated in each traced call (Python 3.4 and up)")
 
 options, args = parser.parse_args()
 
+# Size the request to the system in the current directory instead of the
+# defaults.  --type is the number of cores on the node type.
+if options.auto and os.path.isfile('coord'):
+	try:
+		memPerCore = resources.parseMemory(options.mem)
+	except ValueError as e:
+		parser.error(str(e))
+	autoPlan = resources.plan(os.getcwd(), options.type, memPerCore,
+		options.time)
+	options.cores = autoPlan['cores']
+
+if options.profile != None:
+	profiling.tracer.start(options.profile, options.cprofile, options.tracemalloc)
+
 print options
 print options.time
 createSubmission(options)
 print args
 
+# Decorator for the methods that run or change things in the turbomole
+# directory.  The lease is claimed for the call, and released again when the
+# outermost such call returns, so a long-lived driver only holds leases on
+# the directories it is working in right now.
+def holdsLease(method):
+	@functools.wraps(method)
+	def step(self, *args, **kwargs):
+		self.claim()
+		self.steps += 1
+		try:
+			return method(self, *args, **kwargs)
+		finally:
+			self.steps -= 1
+			if self.steps == 0:
+				self.release()
+	return step
+
 class Turboclass(object):
 
-	# Initialize and create a record of important files
-	def __init__(self, turboDir=None):
+	# Initialize and create a record of important files.  timeouts is an
+	# optional dictionary of program name -> seconds, eg {'ridft': 3600}, after
+	# which a run of that program is killed and counted as failed.
+	# turboDir can also be an archive made by archive.pack, which is opened
+	# read-only: queries like getEnergy work, but nothing can be run or logged.
+	# The log is only opened once the lease on the directory is taken, see
+	# claim, so another job's log is never written to.
+	def __init__(self, turboDir=None, timeouts=None):
 		self.homeDir = os.getcwd()
+		if timeouts == None:
+			timeouts = {}
+		self.timeouts = timeouts
 
 		if turboDir == None:
 			self.turboDir = os.getcwd()
@@ -66,21 +116,32 @@ class Turboclass(object):
 		self.control = os.path.join(self.turboDir, 'control')
 		self.coord = os.path.join(self.turboDir, 'coord')
 
-		# Create and open stream to log file
+		# Log file stream, opened by claim
 		self.logPath = os.path.join(self.turboDir, 'turbohistory.log')
-
-		if os.path.exists(self.logPath) == False:
-			with open(self.logPath, 'w') as createLog:
-				pass
-
-		self.log = open(self.logPath, 'r+')
+		self.log = None
 		self.firstLog = True
 		self.logNum = None
+		self.lease = None
+		self.steps = 0
+
+		# Set by planResources, sizes the Turbomole runs of this directory
+		self.resourcePlan = None
+
+		self.archive = None
+		if os.path.isfile(self.turboDir):
+			self.archive = archive.ArchiveDir(self.turboDir)
+
+	# Opens one of the turbomole files for reading, from the archive if this
+	# instance was made from one
+	def openFile(self, path):
+		if self.archive != None:
+			return self.archive.open(os.path.basename(path))
+		return open(path, 'r')
 
 	# Use of len(turboclassinstance) will return the number of configurations
 	# in the current turbomole directory
 	def __len__(self):
-		with open(self.energy, 'r') as ener_file:
+		with self.openFile(self.energy) as ener_file:
 			ener_file_lines = ener_file.readlines()
 			return len(ener_file_lines[1:-1]) # Doesn't read $end or $energy
 	
@@ -93,6 +154,57 @@ class Turboclass(object):
 		else:
 			return False
 
+	# Takes the lease on the turbomole directory before anything in it is run
+	# or changed, so jobs from other processes or hosts can't work in it at
+	# the same time, then opens the log.  Raises lease.LeaseError if another
+	# live job holds it, and IOError for archives, so batch drivers can skip
+	# the directory.
+	def claim(self):
+		if self.archive != None:
+			message = "Can't run or change anything in %s, archives are " \
+				"read-only" % self.turboDir
+			print message
+			raise IOError(message)
+		if self.lease != None and self.lease.held:
+			return
+		if self.lease != None:
+			self.release() # Lease was lost, eg reclaimed after a stall
+		self.lease = lease.Lease(self.turboDir)
+		try:
+			message = self.lease.acquire()
+		except lease.LeaseError as e:
+			print str(e) # Not logged, the log belongs to the other job
+			raise
+
+		if os.path.exists(self.logPath) == False:
+			with open(self.logPath, 'w') as createLog:
+				pass
+		self.log = open(self.logPath, 'r+')
+		self.firstLog = True
+		self.printLog(message)
+
+	# Closes the log and gives up the lease.  Called when the outermost step
+	# returns, or at the end of a with block.
+	def release(self):
+		if self.log != None:
+			self.log.close()
+			self.log = None
+		if self.lease != None:
+			self.lease.release()
+			self.lease = None
+
+	# "with Turboclass(dir) as turbo:" holds the lease for the whole block, eg
+	# across several steps, and releases it at the end
+	def __enter__(self):
+		self.claim()
+		self.steps += 1
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.steps -= 1
+		if self.steps == 0:
+			self.release()
+
 	# generates machine file in current directory - necessary for trivial
 	# parallelization of NumForce
 	def genMfile(self, MFILE):
@@ -129,6 +241,10 @@ class Turboclass(object):
 	# Used to conveniently write messages to the log file
 	def writeLog(self, message):
 
+		# Only logged while this instance holds the lease, see claim
+		if self.log == None:
+			return
+
 		# First check if this is the first log being written for this instance
 		# and write header if so
 		if self.firstLog == True:
@@ -159,9 +275,8 @@ class Turboclass(object):
 			print message
 			self.writeLog(message)
 
-		# Return a subprocess with the command
-		return subprocess.Popen(command, shell=True, cwd=self.turboDir,
-			stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		# Return the result of running the command
+		return self.run(command)
 
 	# Helper printer function.  Sends text to stdout and/or log
 	# Kind of nice.
@@ -174,16 +289,90 @@ class Turboclass(object):
 		print message
 		self.writeLog(message)
 
-		actual = subprocess.Popen("actual -r", shell=True, cwd=self.turboDir,
-			stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-		
-		actual_out = actual.stdout.read()
+		actual_out = self.run("actual -r").output
 		print actual_out
 		self.writeLog(actual_out.rstrip('\n'))
+
+	# Runs a command in the turbomole directory through runner and returns its
+	# RunResult.  Output goes to <program>.out unless outName is given.  The
+	# timeout defaults to the one set for the program in self.timeouts.
+	# monitor=True follows the run with a JobMonitor, logging each cycle as it
+	# finishes and handing it to callback if one is given.
+	@holdsLease
+	def run(self, command, outName=None, timeout=None, monitor=False,
+		callback=None):
+		program = os.path.basename(command.split()[0])
+		if outName == None:
+			outName = program + '.out'
+		if timeout == None:
+			timeout = self.timeouts.get(program)
+		outPath = os.path.join(self.turboDir, outName)
+		env = None
+		if self.resourcePlan != None:
+			env = resources.environment(self.resourcePlan)
+
+		if not monitor:
+			result = runner.run(command, self.turboDir, outPath, timeout, env)
+		else:
+			mon = JobMonitor(self.turboDir, outPath=outPath,
+				callback=callback, log=self.printLog)
+			proc = runner.Run(command, self.turboDir, outPath, timeout,
+				env).start()
+			for record in mon.follow(proc):
+				pass
+			mon.close()
+			if mon.stopped:
+				self.printLog("%s output reports an abnormal end" % program)
+			result = proc.wait()
+
+		if profiling.tracer.enabled:
+			profiling.tracer.record(program, 'turbomole',
+				result.startTime, result.duration,
+				track=profiling.turbomoleTrack,
+				args={'command': command, 'returncode': result.returncode})
+		if result.timedOut:
+			self.printLog("%s was killed after %d seconds" % (program, timeout))
+		return result
+
+	# Logs the mean time per optimization cycle or NumForce displacement of a
+	# run, which resources.readStepTimes reads back when planning later runs.
+	# Runs followed by a JobMonitor already log every cycle as it finishes.
+	def logStepTime(self, program, result, steps):
+		if steps > 0:
+			self.printLog("%s took %d steps in %.1f s, step time = %.1f s" %
+				(program, steps, result.duration, result.duration / steps))
+
+	# Returns a JobMonitor for a job already running in this directory, eg one
+	# started by another process.  Iterate over it to get each new cycle.
+	def monitor(self, callback=None, outPath='job.last'):
+		return JobMonitor(self.turboDir, outPath=outPath,
+			callback=callback, log=self.printLog)
 	
+	# Picks cores and memory for this system with resources.plan, writes
+	# $ricore/$maxcor into control and sets PARNODES/OMP_NUM_THREADS for the
+	# Turbomole programs this instance starts afterwards, leaving other
+	# directories driven from the same process alone.  The node type, memory per core
+	# and walltime default to the -t, --type and --h_data options.
+	@holdsLease
+	def planResources(self, nodeCores=None, memPerCore=None, walltime=None,
+		steps=20):
+		if nodeCores == None:
+			nodeCores = options.type
+		if memPerCore == None:
+			memPerCore = resources.parseMemory(options.mem)
+		if walltime == None:
+			walltime = options.time
+
+		resourcePlan = resources.plan(self.turboDir, nodeCores, memPerCore,
+			walltime, steps)
+		resources.apply(self.turboDir, resourcePlan)
+		self.resourcePlan = resourcePlan
+		self.printLog(resources.describe(resourcePlan))
+		return resourcePlan
+
 	# Returns the latest energy from the energy file with the specified units
 	def getEnergy(self, units='hartree'):
-		with open(self.energy, 'r') as ener_file:
+		with self.openFile(self.energy) as ener_file:
 			final_line = ener_file.readlines()[-2]
 			iter, ener, kin, pot = final_line.split()
 			conversion = {'hartree': 1, 'eV' : 27.2107, 'ev': 27.2107,
@@ -197,7 +386,7 @@ class Turboclass(object):
 
 	# Helper function for detecting if -ri flags should be used
 	def detect_ri(self):
-		with open(self.control, 'r') as controlFile:
+		with self.openFile(self.control) as controlFile:
 			control_lines = controlFile.read()
 			if "$rij" in control_lines:
 				return True
@@ -205,19 +394,21 @@ class Turboclass(object):
 				return False
 
 	# Helper function for detecting -level <func>
-	# level = CC2, MP2, SCF, not a functional
-	# Fix some other time
+	# level = CC2, MP2, SCF, not a functional.  DFT runs count as scf, and
+	# ricc2 handles both MP2 and CC2 gradients under -level cc2
 	def detect_level(self):
-		#with open(self.control, 'r') as controlFile:
-		#	for line in controlFile:
-		#		if "functional" in line:
-		#			functional, level = line.split()
-		#			return level
-		return 'scf'
+		with self.openFile(self.control) as controlFile:
+			control_lines = controlFile.read()
+			if "$ricc2" in control_lines:
+				return 'cc2'
+			elif "$uff" in control_lines:
+				return 'uff'
+			else:
+				return 'scf'
 
 	# Helper function for detecting -frznuclei flag in numforce
 	def detect_frznuclei(self):
-		with open(self.coord, 'r') as coordFile:
+		with self.openFile(self.coord) as coordFile:
 			for line in coordFile:
 				if line.split()[-1] == 'f':
 					return True
@@ -267,15 +458,47 @@ class Turboclass(object):
 		return stretches, angles, dihedrals
 		
 
+	# Helper function for reading the gradient file up to configuration
+	# geometry.  Returns the lines to keep when rolling back to it, and the
+	# coordinate lines of that configuration (empty if it isn't there)
+	def readGradient(self, geometry):
+		with self.openFile(self.gradient) as gradFile:
+			gradLines = []
+			coordLines = []
+			isCycle = False
+
+			for line in gradFile:
+				if isCycle == True and 'cycle' in line:
+					break
+				if '$end' in line:
+					break
+				gradLines.append(line)
+				if isCycle == True and len(line.split()) > 3:
+					coordLines.append(line)
+				if 'cycle =%7s' % geometry in line:
+					isCycle = True
+
+		return gradLines, coordLines
+
+	# Returns the coord file contents for configuration geometry as recorded
+	# in the gradient file, without changing anything
+	def getGeometry(self, geometry):
+		gradLines, coordLines = self.readGradient(geometry)
+		if coordLines == []:
+			return None
+		return '$coord\n' + ''.join(coordLines) + '$end\n'
+
 	# For rolling back a calculation to a particular configuration.  Method
 	# will truncate energy and gradient files and replace coord with
 	# appropriate geometry
 	# DOES NOT CURRENTLY SUPPORT INTERNAL COORDINATES
+	@holdsLease
 	def rollback(self, geometry=None):
 		
 		# No configuration specified so exit
 		if geometry == None:
 			return
+
 		
 		# Configuration greater than number available
 		if geometry > len(self):
@@ -283,7 +506,7 @@ class Turboclass(object):
 
 
 		# If cartesian coords do one thing, else if internal, do another
-		with open(self.control, 'r') as controlFile:
+		with self.openFile(self.control) as controlFile:
 			lines = controlFile.read()
 			if "$intdef" in lines: # Pick some other metric
 				pass # Do internal specific routine
@@ -291,21 +514,7 @@ class Turboclass(object):
 				pass # Do normal routine
 
 		# Find coords and truncate gradient
-		with open(self.gradient, 'r') as gradFile:
-			gradLines = []
-			coordLines = []
-			isCycle = False
-
-			for line in gradFile:
-				if isCycle == True and 'cycle' in line:
-					break
-				if '$end' in line:
-					break
-				gradLines.append(line)
-				if isCycle == True and len(line.split()) > 3:
-					coordLines.append(line)
-				if 'cycle =%7s' % geometry in line:
-					isCycle = True
+		gradLines, coordLines = self.readGradient(geometry)
 
 		# Throw error if no coordinates found in gradient file
 		if coordLines == []:
@@ -319,7 +528,7 @@ class Turboclass(object):
 			sys.exit(1)
 
 		# Truncate energies
-		with open(self.energy, 'r') as enerFile:
+		with self.openFile(self.energy) as enerFile:
 			ener_lines = enerFile.readlines()
 			ener_lines = ener_lines[:geometry+1]
 		with open(self.energy, 'w') as enerFile:
@@ -346,6 +555,7 @@ class Turboclass(object):
 	# For running a simple ridft.  Rollback variable implemented for easy recall
 	# of an energy for a particular geometry.  Rollback feature could be
 	# implemented here or in a dedicated rollback function
+	@holdsLease
 	def ridft(self, rollback=None):
 
 		# Implement some other time
@@ -354,15 +564,13 @@ class Turboclass(object):
 		
 		print "Submitting ridft command"
 		self.writeLog('Submitting ridft command')
-		p = subprocess.Popen("ridft", shell=True, cwd=self.turboDir, 
-									stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-		out = p.stdout.read()
-		print out
+		result = self.run("ridft")
+		print result.output
 
 		# Error several times before terminating
 		tries = 1
 		numtries = 2
-		while "ridft ended abnormally" in out:
+		while result.failed("ridft ended abnormally"):
 			if tries > numtries:
 				print "ridft has failed for unknown reasons and could not be " \
 						"recovered.  Check that the setup is alright"
@@ -374,10 +582,8 @@ class Turboclass(object):
 			
 			print "Re-attempting ridft"
 			self.writeLog("Re-attempting ridft")
-			p = subprocess.Popen("ridft", shell=True, cwd=self.turboDir,
-								stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-			out = p.stdout.read()
-			print out
+			result = self.run("ridft")
+			print result.output
 			
 			tries += 1
 
@@ -387,6 +593,7 @@ class Turboclass(object):
 	# For running a simple rdgrad.  Rollback variable implemented for easy 
 	# recall of a gradient for a particular geometry.  Rollback feature could be
 	# implemented here or in a dedicated rollback function
+	@holdsLease
 	def rdgrad(self, rollback=None):
 		
 		# Implement some other time
@@ -395,15 +602,13 @@ class Turboclass(object):
 
 		print "Submitting rdgrad command"
 		self.writeLog("Submitting rdgrad command")
-		p = subprocess.Popen("rdgrad", shell=True, cwd=self.turboDir,
-									stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-		out = p.stdout.read()
-		print out
+		result = self.run("rdgrad")
+		print result.output
 
 		# Error several times and troubleshoot
 		tries = 1
 		numtries = 2
-		while "rdgrad ended abnormally" in out:
+		while result.failed("rdgrad ended abnormally"):
 			if tries > numtries:
 				print "rdgrad has failed for unknown reasons and could not be " \
 						"recovered.  Check that the setup is alright."
@@ -416,16 +621,16 @@ class Turboclass(object):
 	
 			print "Re-attempting rdgrad"
 			self.writeLog("Re-attempting rdgrad")
-			p = subprocess.Popen("rdgrad", shell=True, cwd=self.turboDir,
-								stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-			out = p.stdout.read()
-			print out
+			result = self.run("rdgrad")
+			print result.output
 			
 			# Try running ridft to fix the problem
-			if "rdgrad ended abnormally" in out:
+			if result.failed("rdgrad ended abnormally"):
 				print "actual -r didn't work.  Trying new ridft."
 				self.writeLog("actual -r didn't work.  Trying new ridft.")
 				self.ridft()
+
+			tries += 1
 		
 		print "rdgrad has successfully finished"
 		self.writeLog("rdgrad has successfully finished")
@@ -437,9 +642,14 @@ class Turboclass(object):
 	# readable method with more advanced error handling.  Maybe.
 	# level should automatically detect its function from the control file
 	# -l, -ls, -md, -mdfile, -mdscript, -help will probably not be implemented
+	# monitor=True follows energy, gradient and jobex.out while jobex runs and
+	# logs each cycle as it finishes, handing it to callback if one is given
+	# tune=True sizes cores and memory to the system first, see planResources
+	@holdsLease
 	def jobex(self, rollback=None, energy=6, gcart=3, c=20, dscf=False, 
 		grad=False, statpt=False, relax=False, trans=False, level='',
-		ri='', rijk=False, ex=False, keep=False):
+		ri='', rijk=False, ex=False, keep=False, monitor=False, callback=None,
+		tune=False):
 
 		# Record number of starting configurations		
 		init_configs = len(self)
@@ -449,6 +659,8 @@ class Turboclass(object):
 			ri = self.detect_ri()
 		if level == '':
 			level = self.detect_level()
+		if tune:
+			self.planResources(steps=c)
 
 		# Organize True/False args into a dictionary of a dictonary for easy access
 		flags = { 
@@ -481,16 +693,16 @@ class Turboclass(object):
 		# Begin sending commands to the shell
 		print "Submitting command %s" % comm
 		self.writeLog("Submitting command %s" % comm)
-		opt = subprocess.Popen(comm, shell=True, cwd=self.turboDir,
-			stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-		
-		opt_out = opt.stdout.read()
-		print opt_out
+		before = len(self)
+		opt = self.run(comm, monitor=monitor, callback=callback)
+		if not monitor:
+			self.logStepTime('jobex', opt, len(self) - before)
+		print opt.output
 
 		# Super shitty troubleshooting.  Needs refining.
 		tries = 1
 		numtries = 2
-		while "program stopped" in opt_out:
+		while opt.failed("program stopped"):
 			if tries > numtries:
 				print "jobex has failed for unknown reasons and could not be " \
 					"recovered.  Check that the setup is alright."
@@ -503,14 +715,14 @@ class Turboclass(object):
 
 			print "Re-attempting %s command" % comm
 			self.writeLog("Re-attempting %s command" % comm)
-			new_opt = subprocess.Popen(comm, shell=True, cwd=self.turboDir,
-				stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-			opt_out = new_opt.stdout.read()
-			print opt_out
+			before = len(self)
+			opt = self.run(comm, monitor=monitor, callback=callback)
+			if not monitor:
+				self.logStepTime('jobex', opt, len(self) - before)
+			print opt.output
 
 			# Try running ridft to fix the problem, if there was one
-			if "program stopped" in opt_out:
+			if opt.failed("program stopped"):
 				print "actual -r didn't work.  Trying new ridft."
 				self.writeLog("actual -r didn't work.  Trying new ridft.")
 				self.ridft()
@@ -532,11 +744,13 @@ class Turboclass(object):
 	#  automatic ri
 	#  automatic level
 	#  mfile generation
+	# tune=True sizes cores and memory to the system first, see planResources
+	@holdsLease
 	def numforce(self, rollback=None, ri='', rijk=False, level='',
 		ex='', d='', thrgrd='', central=False, polyedr=False,
 		ecnomic=False, diatmic=False, size='', mfile='', i=False,
 		c=False, prep=False, l='', ls='', scrpath='', override=False,
-		frznuclei='', cosmo=False):
+		frznuclei='', cosmo=False, tune=False):
 
 		# Auto-detect some flags
 		if ri == '':
@@ -545,6 +759,13 @@ class Turboclass(object):
 			level = self.detect_level()
 		if frznuclei == '':
 			frznuclei = self.detect_frznuclei()
+
+		# One displaced gradient per cartesian, two with -central
+		displacements = 3 * resources.countAtoms(self.coord)
+		if central:
+			displacements *= 2
+		if tune:
+			self.planResources(steps=displacements)
 		
 		if level != '':
 			level = " -level %s" % level
@@ -603,14 +824,12 @@ class Turboclass(object):
 
 		text = "Submitting command %s" % comm
 		num_run = self.sendToTerminal(comm, text)
-
-		num_out = num_run.stdout.read()
-		print num_out
+		print num_run.output
 
 		# Try to troubleshoot
 		tries = 1
 		numtries = 2
-		while "program stopped" in num_out:
+		while num_run.failed("program stopped"):
 
 			# Terminal error
 			if tries > numtries:
@@ -626,12 +845,10 @@ class Turboclass(object):
 
 			text = "Re-submitting command %s" % comm
 			num_run = self.sendToTerminal(comm, text)
-
-			num_out = num_run.stdout.read()
-			print num_out
+			print num_run.output
 
 			# Try running ridft and rdgrad to fix the problem if there was one
-			if "program stopped" in num_out:
+			if num_run.failed("program stopped"):
 				print "actual -r didn't work.  Trying ridft -> rdgrad."
 				self.writeLog("actual -r didn't work.  Trying ridft -> rdgrad.")
 				self.ridft()
@@ -641,9 +858,10 @@ class Turboclass(object):
 				self.rdgrad()
 			
 			tries += 1
+		self.logStepTime('NumForce', num_run, displacements)
 			
 		# Check for missing gradient error
-		if "Can not find data group $grad" in num_out:
+		if "Can not find data group $grad" in num_run.output:
 			print "Gradient is missing.  Running rdgrad."
 			self.writeLog("Gradient is missing.  Running rdgrad.")
 			self.rdgrad()
@@ -701,6 +919,215 @@ class Turboclass(object):
 		print "Angles: ", angles # DELETE
 		print "Dihedrals: ", dihedrals # DELETE
 
+	# For tiered optimizations.  Pre-optimizes at a cheap level in cheapDir,
+	# then carries the geometry (and the MOs, if both levels use the same
+	# basis) back to this directory and finishes at the level set here.
+	# If cheapDir doesn't exist it is copied from this directory with looser
+	# SCF convergence, a smaller DFT grid and RI switched on when an auxbasis
+	# is available.  A cheapDir prepared beforehand, eg with a smaller basis
+	# from define, is used as is.  Frozen atoms and $intdef come along with
+	# coord and control.  cheap overrides the settings of the cheap level,
+	# other keyword arguments go to both jobex runs.
+	# Once the geometry has been carried over, PRELEVEL_CARRIED is written
+	# here, and a resubmitted job goes straight on with the target level
+	# instead of starting it over from the cheap geometry.
+	@holdsLease
+	def multilevel_opt(self, cheapDir=None, cheap=None, energy=6, gcart=3,
+		c=20, **kwargs):
+
+		carried = os.path.join(self.turboDir, 'PRELEVEL_CARRIED')
+		if os.path.exists(carried):
+			self.printLog("Cheap level already carried over, continuing at " \
+				"the target level")
+			self.jobex(energy=energy, gcart=gcart, c=c, **kwargs)
+			return
+
+		if cheapDir == None:
+			cheapDir = os.path.join(self.turboDir, 'prelevel')
+		cheapDir = os.path.realpath(cheapDir)
+
+		settings = {'energy': 5, 'gcart': 2, 'c': c, 'scfconv': 5,
+			'gridsize': 'm1', 'ri': True}
+		if cheap != None:
+			settings.update(cheap)
+
+		if not os.path.isdir(cheapDir):
+			self.printLog("Setting up cheap level in %s" % cheapDir)
+			self.copy_turbodir(cheapDir)
+			self.loosen_control(os.path.join(cheapDir, 'control'), settings)
+
+		# Cheap pre-optimization, skipped if a previous run already converged it
+		if os.path.exists(os.path.join(cheapDir, 'GEO_OPT_CONVERGED')):
+			self.printLog("Cheap level already converged in %s" % cheapDir)
+		else:
+			self.printLog("Pre-optimizing at the cheap level in %s" % cheapDir)
+			pre = Turboclass(cheapDir)
+			pre.jobex(energy=settings['energy'], gcart=settings['gcart'],
+				c=settings['c'], **kwargs)
+
+		# Carry geometry over, and MOs if the basis is the same
+		shutil.copy(os.path.join(cheapDir, 'coord'), self.coord)
+		if self.same_basis(cheapDir):
+			for moFile in self.mo_files():
+				cheapMO = os.path.join(cheapDir, moFile)
+				if os.path.isfile(cheapMO):
+					shutil.copy(cheapMO, os.path.join(self.turboDir, moFile))
+			self.printLog("Geometry and MOs carried over from the cheap level")
+		else:
+			self.printLog("Geometry carried over from the cheap level.  " \
+				"Basis sets differ, so the MOs here are kept.")
+		with open(carried, 'w') as carriedFile:
+			carriedFile.write(cheapDir + '\n')
+
+		self.printLog("Finishing optimization at the target level")
+		self.jobex(energy=energy, gcart=gcart, c=c, **kwargs)
+
+	# Helper function for copying the files of this directory into a new one,
+	# leaving out logs and jobex bookkeeping
+	def copy_turbodir(self, newDir):
+		skip = ['turbohistory.log', 'jobex.out', 'GEO_OPT_CONVERGED',
+			'GEO_OPT_FAILED', 'GEO_OPT_RUNNING', 'PRELEVEL_CARRIED',
+			lease.leaseName, lease.leaseName + '.lock']
+		os.makedirs(newDir)
+		for name in os.listdir(self.turboDir):
+			path = os.path.join(self.turboDir, name)
+			if name in skip or name.startswith('job.') or not os.path.isfile(path):
+				continue
+			shutil.copy(path, newDir)
+
+	# Helper function for making a control file cheaper with the scfconv,
+	# gridsize and ri entries of settings
+	def loosen_control(self, control, settings):
+		resources.setControlGroup(control, '$scfconv', settings['scfconv'])
+
+		with open(control, 'r') as controlFile:
+			lines = controlFile.read()
+		lines = re.sub(r'(\n\s+gridsize\s+)\S+', r'\g<1>' + settings['gridsize'],
+			lines)
+		auxbasis = os.path.join(os.path.dirname(control), 'auxbasis')
+		if settings['ri'] and "$rij" not in lines and os.path.isfile(auxbasis):
+			lines = lines.replace('$end', '$rij\n$jbas    file=auxbasis\n' \
+				'$marij\n$end')
+		with open(control, 'w') as controlFile:
+			controlFile.write(lines)
+
+	# Helper function returning the MO files named in control
+	def mo_files(self):
+		moFiles = []
+		with self.openFile(self.control) as controlFile:
+			for line in controlFile:
+				if line.startswith('$scfmo') or line.startswith('$uhfmo'):
+					for field in line.split():
+						if field.startswith('file='):
+							moFiles.append(field[len('file='):])
+		return moFiles
+
+	# Helper function for checking that otherDir uses the same basis set, in
+	# which case its MOs are a valid start here
+	def same_basis(self, otherDir):
+		otherBasis = os.path.join(otherDir, 'basis')
+		thisBasis = os.path.join(self.turboDir, 'basis')
+		if not os.path.isfile(otherBasis) or not os.path.isfile(thisBasis):
+			return False
+		with open(otherBasis, 'r') as otherFile:
+			with open(thisBasis, 'r') as thisFile:
+				return otherFile.read() == thisFile.read()
+
+	# Seeds this directory from the most similar converged structure in the
+	# similarity index at indexPath: MOs if the atoms and basis match, the
+	# approximate Hessian of statpt/relax, and $intdef if there is none here.
+	# Does nothing if the closest structure is more than maxRMSD bohr away.
+	# Returns the directory used, or None.
+	@holdsLease
+	def warm_start(self, indexPath, maxRMSD=0.5):
+		index = similarity.GeometryIndex(indexPath)
+		best = index.nearest(self.coord, exclude=self.turboDir)
+		for missing in index.missing:
+			self.printLog("Skipped %s from the index, it no longer exists" % missing)
+		if best == None or best[1] > maxRMSD:
+			self.printLog("No converged structure close enough to start from")
+			return None
+		neighbour, rmsd = best
+		self.printLog("Starting from %s (%.4f bohr away)" % (neighbour, rmsd))
+
+		# Read the neighbour through plain paths only, it may belong to a job
+		# that is still running
+		otherControl = os.path.join(neighbour, 'control')
+
+		# Orbitals are only a valid guess for the same atoms in the same basis
+		sameAtoms = resources.countAtoms(self.coord) == \
+			resources.countAtoms(os.path.join(neighbour, 'coord'))
+		if sameAtoms and self.same_basis(neighbour):
+			for moFile in self.mo_files():
+				otherMO = os.path.join(neighbour, moFile)
+				if os.path.isfile(otherMO):
+					shutil.copy(otherMO, os.path.join(self.turboDir, moFile))
+					self.printLog("Copied MOs from %s" % otherMO)
+
+		for group in ['$forceapprox', '$hessapprox']:
+			hessFile = self.data_group_file(group)
+			if sameAtoms and hessFile != None and \
+				os.path.isfile(os.path.join(neighbour, hessFile)):
+				shutil.copy(os.path.join(neighbour, hessFile),
+					os.path.join(self.turboDir, hessFile))
+				self.printLog("Copied Hessian guess %s" % hessFile)
+
+		# Frozen internals, unless this directory already defines its own
+		intdef = None
+		if os.path.isfile(otherControl):
+			intdef = self.data_group('$intdef', otherControl)
+		if intdef != None and self.data_group('$intdef') == None:
+			with self.openFile(self.control) as controlFile:
+				lines = controlFile.read()
+			with open(self.control, 'w') as controlFile:
+				controlFile.write(lines.replace('$end', intdef + '$end', 1))
+			self.printLog("Copied $intdef from %s" % neighbour)
+
+		return neighbour
+
+	# Helper function returning the file a control data group points to, eg
+	# 'forceapprox' for "$forceapprox    file=forceapprox", or None
+	def data_group_file(self, group):
+		with self.openFile(self.control) as controlFile:
+			for line in controlFile:
+				fields = line.split()
+				if len(fields) > 1 and fields[0] == group and \
+					fields[1].startswith('file='):
+					return fields[1][len('file='):]
+		return None
+
+	# Helper function returning a whole control data group, its $ line and
+	# the lines under it, or None if control doesn't have it.  Reads this
+	# directory's control unless the path of another one is given.
+	def data_group(self, group, control=None):
+		block = None
+		if control == None:
+			controlFile = self.openFile(self.control)
+		else:
+			controlFile = open(control, 'r')
+		with controlFile:
+			for line in controlFile:
+				if block != None:
+					if line.startswith('$'):
+						break
+					block += line
+				elif line.split()[:1] == [group]:
+					block = line
+		return block
+
+	# For transition state searches with frozen coordinates.  Runs the
+	# multilevel optimization with jobex -trans, so most of the cycles happen
+	# at the cheap level.  otherflags is a dictionary of multilevel_opt
+	# keyword arguments.
+	@holdsLease
 	def constrained_int_ts(self, rollback=None, otherflags=None):
-		pass
-	
+		if rollback != None:
+			self.rollback(rollback)
+		if otherflags == None:
+			otherflags = {}
+
+		otherflags['trans'] = True
+		self.multilevel_opt(**otherflags)
+
+# Every method shows up in the --profile timeline
+profiling.instrument(Turboclass)
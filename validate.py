@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+__author__='Nathan Gallup'
+'''
+===========================
+validate.py
+
+For checking a whole campaign of Turbomole directories before submitting it.
+Each directory is checked in its own worker process for a readable coord with
+$end, a control whose atom count matches coord, basis and auxbasis files that
+cover every element, and atoms sitting on top of each other.  Can also convert
+coord files to and from XYZ across all of the directories.
+
+Usage: validate.py [-j processes] [--toxyz | --fromxyz] <directories>
+===========================
+'''
+
+import sys, os, optparse, multiprocessing
+import resources
+
+# Turbomole coord files are in bohr, XYZ files in angstrom
+bohrToAngstrom = 0.52917721
+
+# Atoms closer than this (bohr) are reported as overlapping
+overlapDistance = 0.9
+
+
+# Reads a coord file and returns (atoms, problems).  atoms is a list of
+# (element, x, y, z, frozen) tuples.
+def readCoord(coord):
+	atoms = []
+	problems = []
+
+	with open(coord, 'r') as coordFile:
+		lines = coordFile.readlines()
+	if len(lines) == 0 or not lines[0].startswith('$coord'):
+		problems.append("coord does not start with $coord")
+	if not any([line.startswith('$end') for line in lines]):
+		problems.append("coord has no $end")
+
+	inCoord = False
+	for number, line in enumerate(lines):
+		if line.startswith('$'):
+			inCoord = line.startswith('$coord')
+			continue
+		if not inCoord or len(line.split()) == 0:
+			continue
+
+		fields = line.split()
+		frozen = len(fields) == 5 and fields[4] == 'f'
+		if len(fields) not in [4, 5] or (len(fields) == 5 and not frozen):
+			problems.append("coord line %d is not 'x y z element [f]'" % (number+1))
+			continue
+		try:
+			x, y, z = [float(value) for value in fields[:3]]
+		except ValueError:
+			problems.append("coord line %d has a bad coordinate" % (number+1))
+			continue
+		atoms.append((fields[3].lower(), x, y, z, frozen))
+
+	if len(atoms) == 0:
+		problems.append("coord has no atoms")
+	return atoms, problems
+
+# Returns a list of (i, j, distance) for atom pairs closer than cutoff.  Atoms
+# are binned into cubes of side cutoff, so only neighbouring cubes are
+# compared and large systems stay linear in the number of atoms.
+def closeContacts(atoms, cutoff=overlapDistance):
+	cells = {}
+	for index, atom in enumerate(atoms):
+		key = (int(atom[1] // cutoff), int(atom[2] // cutoff),
+			int(atom[3] // cutoff))
+		cells.setdefault(key, []).append(index)
+
+	contacts = []
+	offsets = [(a, b, c) for a in (-1, 0, 1) for b in (-1, 0, 1)
+		for c in (-1, 0, 1)]
+	for key, members in cells.items():
+		for offset in offsets:
+			neighbour = (key[0]+offset[0], key[1]+offset[1], key[2]+offset[2])
+			for i in members:
+				for j in cells.get(neighbour, []):
+					if j <= i:
+						continue
+					distance = ((atoms[i][1] - atoms[j][1])**2 +
+						(atoms[i][2] - atoms[j][2])**2 +
+						(atoms[i][3] - atoms[j][3])**2) ** 0.5
+					if distance < cutoff:
+						contacts.append((i+1, j+1, distance))
+	return sorted(contacts)
+
+# Checks control against the atoms in coord and returns a list of problems
+def checkControl(control, atoms):
+	problems = []
+	with open(control, 'r') as controlFile:
+		lines = controlFile.read()
+
+	if '$end' not in lines:
+		problems.append("control has no $end")
+	for line in lines.splitlines():
+		if line.strip().startswith('natoms='):
+			natoms = int(line.split('=')[1])
+			if natoms != len(atoms):
+				problems.append("control has natoms=%d but coord has %d atoms" %
+					(natoms, len(atoms)))
+	return problems
+
+# Checks that basis (and auxbasis, if RI is on) cover every element
+def checkBasis(turboDir, atoms):
+	problems = []
+	elements = set([atom[0] for atom in atoms])
+
+	with open(os.path.join(turboDir, 'control'), 'r') as controlFile:
+		needAux = '$jbas' in controlFile.read()
+
+	for name, needed in [('basis', True), ('auxbasis', needAux)]:
+		path = os.path.join(turboDir, name)
+		if not needed:
+			continue
+		if not os.path.isfile(path):
+			problems.append("%s is missing" % name)
+			continue
+		missing = elements - set(resources.readBasisSizes(path).keys())
+		if len(missing) > 0:
+			problems.append("%s has no entry for %s" % (name,
+				', '.join(sorted(missing))))
+	return problems
+
+# Runs every check on one directory and returns (directory, problems).  Kept
+# at module level so multiprocessing can send it to the workers.
+def validateDir(turboDir):
+	problems = []
+	for name in ['coord', 'control']:
+		if not os.path.isfile(os.path.join(turboDir, name)):
+			problems.append("%s is missing" % name)
+	if len(problems) > 0:
+		return turboDir, problems
+
+	try:
+		atoms, problems = readCoord(os.path.join(turboDir, 'coord'))
+		for i, j, distance in closeContacts(atoms):
+			problems.append("atoms %d and %d overlap (%.3f bohr apart)" %
+				(i, j, distance))
+		problems += checkControl(os.path.join(turboDir, 'control'), atoms)
+		problems += checkBasis(turboDir, atoms)
+	except Exception as e:
+		problems.append("could not be read: %s" % e)
+	return turboDir, problems
+
+# Writes an XYZ file in angstrom from a coord file
+def coordToXyz(coord, xyz):
+	atoms, problems = readCoord(coord)
+	with open(xyz, 'w') as xyzFile:
+		xyzFile.write("%d\n%s\n" % (len(atoms), os.path.realpath(coord)))
+		for element, x, y, z, frozen in atoms:
+			xyzFile.write("%-2s %16.10f %16.10f %16.10f\n" % (element.capitalize(),
+				x * bohrToAngstrom, y * bohrToAngstrom, z * bohrToAngstrom))
+
+# Returns the lines of the data groups that follow $coord in a coord file,
+# eg $user-defined bonds, without $end
+def extraGroups(coord):
+	extra = []
+	with open(coord, 'r') as coordFile:
+		inCoord = False
+		for line in coordFile:
+			if line.startswith('$end'):
+				break
+			if line.startswith('$'):
+				inCoord = line.startswith('$coord')
+			if not inCoord:
+				extra.append(line)
+	return extra
+
+# Writes a coord file in bohr from an XYZ file.  If coord already exists with
+# the same atoms in the same order, its frozen atoms (see freeze.py) and other
+# data groups are kept.  If the atoms differ and they would be lost, coord is
+# left alone and ValueError is raised.
+def xyzToCoord(xyz, coord):
+	with open(xyz, 'r') as xyzFile:
+		lines = xyzFile.readlines()
+	natoms = int(lines[0])
+	if len(lines) < 2 + natoms:
+		raise ValueError("%s has fewer than %d atoms" % (xyz, natoms))
+
+	# Convert everything before touching coord, so a bad XYZ leaves it alone
+	atoms = []
+	for line in lines[2:2+natoms]:
+		element, x, y, z = line.split()[:4]
+		atoms.append((element.lower(), float(x) / bohrToAngstrom,
+			float(y) / bohrToAngstrom, float(z) / bohrToAngstrom))
+
+	frozen = [False] * len(atoms)
+	extra = []
+	if os.path.isfile(coord):
+		oldAtoms, problems = readCoord(coord)
+		oldExtra = extraGroups(coord)
+		if [atom[0] for atom in oldAtoms] == [atom[0] for atom in atoms]:
+			frozen = [atom[4] for atom in oldAtoms]
+			extra = oldExtra
+		elif any([atom[4] for atom in oldAtoms]) or len(oldExtra) > 0:
+			raise ValueError("%s has different atoms than %s, which has " \
+				"frozen atoms or other data groups that would be lost" %
+				(xyz, coord))
+
+	coordLines = ['$coord\n']
+	for (element, x, y, z), isFrozen in zip(atoms, frozen):
+		coordLines.append("%20.14f  %20.14f  %20.14f      %s%s\n" %
+			(x, y, z, element, {True: ' f', False: ''}[isFrozen]))
+	coordLines += extra
+	coordLines.append('$end\n')
+	with open(coord, 'w') as coordFile:
+		coordFile.writelines(coordLines)
+
+# Conversions for the worker processes.  Both return (directory, problems) so
+# one bad directory is reported instead of stopping the whole campaign.
+def toXyz(turboDir):
+	try:
+		coordToXyz(os.path.join(turboDir, 'coord'),
+			os.path.join(turboDir, 'coord.xyz'))
+	except Exception as e:
+		return turboDir, ["coord.xyz could not be written: %s" % e]
+	return turboDir, []
+
+def fromXyz(turboDir):
+	try:
+		xyzToCoord(os.path.join(turboDir, 'coord.xyz'),
+			os.path.join(turboDir, 'coord'))
+	except Exception as e:
+		return turboDir, ["coord.xyz could not be converted: %s" % e]
+	return turboDir, []
+
+# Runs function over items across a pool of processes and returns the results
+# in the same order
+def poolMap(function, items, processes=None):
+	pool = multiprocessing.Pool(processes)
+	try:
+		return pool.map(function, items, chunksize=max(1, len(items) // 64))
+	finally:
+		pool.close()
+		pool.join()
+
+# Validates directories across a pool of processes and returns a list of
+# (directory, problems) in the same order
+def validateAll(dirs, processes=None):
+	return poolMap(validateDir, dirs, processes)
+
+if __name__ == '__main__':
+	parser = optparse.OptionParser(usage="validate.py [options] <directories>")
+	parser.add_option('-j',	action="store", type=int, default=None, dest="processes",
+							help="Number of worker processes, all cores by default")
+	parser.add_option('--toxyz',	action="store_true",	default=False,	dest="toxyz",
+							help="Also write coord.xyz in every directory")
+	parser.add_option('--fromxyz',	action="store_true",	default=False,	dest="fromxyz",
+							help="Write coord from coord.xyz before validating")
+	options, dirs = parser.parse_args()
+
+	if len(dirs) == 0:
+		parser.print_usage()
+		sys.exit(1)
+
+	# Directories whose coord.xyz can't be converted are reported, not validated
+	problems = dict([(turboDir, []) for turboDir in dirs])
+	toCheck = dirs
+	if options.fromxyz:
+		for turboDir, failures in poolMap(fromXyz, dirs, options.processes):
+			problems[turboDir] += failures
+		toCheck = [turboDir for turboDir in dirs if len(problems[turboDir]) == 0]
+
+	for turboDir, failures in validateAll(toCheck, options.processes):
+		problems[turboDir] += failures
+
+	if options.toxyz:
+		good = [turboDir for turboDir in toCheck if len(problems[turboDir]) == 0]
+		for turboDir, failures in poolMap(toXyz, good, options.processes):
+			problems[turboDir] += failures
+
+	bad = 0
+	for turboDir in dirs:
+		if len(problems[turboDir]) > 0:
+			bad += 1
+			print "%s:" % turboDir
+			for problem in problems[turboDir]:
+				print "    %s" % problem
+
+	print "%d directories checked, %d with problems" % (len(dirs), bad)
+	if bad > 0:
+		sys.exit(1)